@@ -5,30 +5,53 @@
 import argparse
 import sys
 import os
-import glob
 import subprocess
 import re
-import copy
 import pathlib
 import time
 import enum
+import stat
+import functools
+import itertools
+import hashlib
+import json
 import yaml
 
+try:
+    from yaml import CSafeLoader as _SafeLoader
+except ImportError:
+    from yaml import SafeLoader as _SafeLoader
+
 
 class Constants:
     @staticmethod
+    @functools.lru_cache(maxsize=1)
     def generated_by_us_string():
         return "# Generated by arduino-genmakefile\n"
 
     @staticmethod
+    @functools.lru_cache(maxsize=1)
     def header_strings():
+        # Returns a tuple since the result is cached, callers needing a list have to copy it
         cmd_line = sys.argv.copy()
         cmd_line[0] = os.path.basename(cmd_line[0])
-        return [Constants.generated_by_us_string(),
+        return (Constants.generated_by_us_string(),
                 "#\n",
                 "# Command line:\n",
                 "# " + ' '.join(cmd_line) + "\n",
-                "\n"]
+                "\n")
+
+    @staticmethod
+    def makefile_placeholders():
+        # In the order in which they are handled when a line contains several of them
+        return ("LIBS_PLACEHOLDER", "FQBN_PLACEHOLDER", "BINDIR_PLACEHOLDER", "BINFILE_PLACEHOLDER", "CFLAGS_PLACEHOLDER",
+                "SKETCH_NOEXT_PLACEHOLDER", "DEBUG_COMMAND_PLACEHOLDER", "BAUDRATE_PLACEHOLDER")
+
+    @staticmethod
+    def qmake_placeholders():
+        # In the order in which they are handled when a line contains several of them
+        return ("TARGET_PLACEHOLDER", "MAKEFILE_PLACEHOLDER", "PRIFILE_PLACEHOLDER", "DEFINES_PLACEHOLDER",
+                "OTHER_FILES_PLACEHOLDER", "SOURCES_PLACEHOLDER", "HEADERS_PLACEHOLDER", "INCLUDEPATH_PLACEHOLDER")
 
     @staticmethod
     def default_debug_command():
@@ -44,6 +67,11 @@ class Paths:
     def templates_dir():
         return Path(os.path.join(os.path.dirname(__file__), "templates"))
 
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def home_dir():
+        return os.path.expanduser("~/")
+
     @staticmethod
     def makefile_default_template_path():
         return Path(os.path.join(Paths.templates_dir().path, "Makefile"))
@@ -66,6 +94,13 @@ class Error:
 
 class Path:
     # pylint: disable=too-many-public-methods
+    # Placeholders are searched as plain substrings, like str.replace() does, longest names first
+    placeholder_regex = re.compile('|'.join(re.escape(placeholder) for placeholder in
+                                            sorted(Constants.makefile_placeholders() + Constants.qmake_placeholders(),
+                                                   key=len, reverse=True)))
+    # Parsed templates, indexed by real path
+    template_cache = {}
+
     class Type(enum.Enum):
         Relative = 0
         Absolute = 1
@@ -82,6 +117,12 @@ class Path:
             raise ValueError("Base dir " + basedir + " is not valid (exists and is not a directory")
         return True
 
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def realpath(path):
+        # Resolving a path costs several syscalls, and results don't change during a run
+        return os.path.realpath(path)
+
     @staticmethod
     def to_string(path):
         if isinstance(path, Path):
@@ -95,18 +136,28 @@ class Path:
         if path.startswith("~/"):
             # path is something like ~/some/path
             self._type = Path.Type.User
-            self.basedir = os.path.expanduser("~/")
-            self.path = os.path.realpath(os.path.expanduser(path))
+            self.basedir = Paths.home_dir()
+            self.path = Path.realpath(os.path.expanduser(path))
         elif os.path.isabs(path):
             # path is something like /some/path
             self._type = Path.Type.Absolute
-            self.path = os.path.realpath(path)
+            self.path = Path.realpath(path)
         else:
             # path is something like some/path, basedir something like /some/directory
             Path.check_basedir_valid(basedir)
             self._type = Path.Type.Relative
             self.basedir = basedir
-            self.path = os.path.realpath(os.path.join(basedir, path))
+            self.path = Path.realpath(os.path.join(basedir, path))
+        self.cached_stat_kind = None
+
+    @staticmethod
+    def from_real_path(real_path, path_type, basedir=None):
+        # Build a Path from an already resolved path, without the syscalls done by os.path.realpath()
+        ret = Path.__new__(Path)
+        ret.__dict__.update(_type=path_type, path=os.path.normpath(real_path), cached_stat_kind=None)
+        if basedir is not None:
+            ret.basedir = Path.to_string(basedir)
+        return ret
 
     def __eq__(self, other):
         return self.path == other.path
@@ -121,11 +172,17 @@ class Path:
             raise ValueError("Calling rel_path() on an absolute path")
         return os.path.relpath(self.path, self.basedir)
 
-    def with_extension(self, extension):
-        ret = copy.deepcopy(self)
-        ret.path = str(pathlib.Path(self.path).with_suffix(extension))
+    def with_path(self, path):
+        # All attributes are immutable, so sharing them with the new instance is safe
+        ret = Path.__new__(Path)
+        ret.__dict__.update(self.__dict__)
+        ret.cached_stat_kind = None
+        ret.path = path
         return ret
 
+    def with_extension(self, extension):
+        return self.with_path(str(pathlib.PurePath(self.path).with_suffix(extension)))
+
     def isuser(self):
         return self._type == Path.Type.User
 
@@ -135,14 +192,26 @@ class Path:
     def isrel(self):
         return self._type == Path.Type.Relative
 
-    def exists(self):
-        return os.path.exists(self.path)
-
     def isfile(self):
         return os.path.isfile(self.path)
 
-    def isdir(self):
-        return os.path.isdir(self.path)
+    def stat_kind(self):
+        # Return "missing", "file", "dir" or "other", using a single cached stat() call
+        kind = self.cached_stat_kind
+        if kind is None:
+            try:
+                mode = os.stat(self.path).st_mode
+            except (OSError, ValueError):
+                kind = "missing"
+            else:
+                if stat.S_ISREG(mode):
+                    kind = "file"
+                elif stat.S_ISDIR(mode):
+                    kind = "dir"
+                else:
+                    kind = "other"
+            self.cached_stat_kind = kind
+        return kind
 
     def isemptyfile(self):
         return self.isfile() and os.path.getsize(self.path) == 0
@@ -151,35 +220,84 @@ class Path:
         return os.path.basename(self.path)
 
     def parent_dir(self):
-        ret = copy.deepcopy(self)
-        ret.path = os.path.dirname(self.path)
-        return ret
+        return self.with_path(os.path.dirname(self.path))
 
     def generated_by_us(self):
-        for line in self.read_lines():
-            if line.startswith(Constants.generated_by_us_string()):
-                return True
+        # Our signature is on the first line, or on the second one for scripts starting with a shebang,
+        # so there is no need to read the whole file
+        try:
+            with open(self.path, "r", encoding="utf8") as file:
+                for line in itertools.islice(file, 2):
+                    if line.startswith(Constants.generated_by_us_string()):
+                        return True
+        except (OSError, UnicodeDecodeError):
+            return False
         return False
 
     def safely_remove_or_exit(self):
-        if not self.exists():
+        kind = self.stat_kind()
+        if kind == "missing":
             return
-        if not self.isfile():
+        if kind != "file":
             Error.exit_on_error(self.path + " cannot be safely removed (not a file), please remove it manually")
 
         if not self.generated_by_us() and not self.isemptyfile():
             Error.exit_on_error(self.path + " cannot be safely removed (not empty, not generated by us), please remove it manually")
 
         os.remove(self.path)
+        self.cached_stat_kind = None
 
     def read_lines(self):
         with open(self.path, "r", encoding="utf8") as file:
             lines = file.readlines()
         return lines
 
+    def read_template(self):
+        # Return the template as a list of (placeholders, line) tuples, placeholders being a tuple of the known
+        # placeholders found in the line, empty for lines without any
+        if self.path not in Path.template_cache:
+            template = self.read_compiled_template()
+            if template is None:
+                template = self.tokenize_template()
+            Path.template_cache[self.path] = template
+        return Path.template_cache[self.path]
+
+    def tokenize_template(self):
+        template = []
+        for line in self.read_lines():
+            placeholders = tuple(dict.fromkeys(Path.placeholder_regex.findall(line)))
+            template.append((placeholders, line))
+        return template
+
+    def compiled_template_path(self):
+        return self.with_path(self.path + ".tmpl.json")
+
+    def read_compiled_template(self):
+        # Templates can be tokenized in advance by tools/compile_templates.py,
+        # the result is ignored when the template was modified afterwards
+        compiled_path = self.compiled_template_path()
+        try:
+            if os.path.getmtime(compiled_path.path) < os.path.getmtime(self.path):
+                return None
+            with open(compiled_path.path, "r", encoding="utf8") as file:
+                data = json.load(file)
+            template = []
+            for placeholders, line in data:
+                if not isinstance(placeholders, list) or not isinstance(line, str):
+                    return None
+                template.append((tuple(placeholders), line))
+            return template
+        except (OSError, ValueError, TypeError):
+            return None
+
+    def write_compiled_template(self):
+        with open(self.compiled_template_path().path, "w", encoding="utf8") as file:
+            json.dump(self.tokenize_template(), file)
+
     def write_lines(self, lines):
-        with open(self.path, "a", encoding="utf8") as file:
-            file.writelines(lines)
+        with open(self.path, "w", encoding="utf8") as file:
+            file.write(''.join(lines))
+        self.cached_stat_kind = None
 
     @staticmethod
     def list_from_key(key, config_dir):
@@ -191,23 +309,27 @@ class Path:
     @staticmethod
     def check_files_exist(paths):
         for path in paths:
-            if not path.exists():
+            kind = path.stat_kind()
+            if kind == "missing":
                 raise FileNotFoundError(path.path + " doesn't exist")
-            if not path.isfile():
+            if kind != "file":
                 raise FileExistsError(path.path + " is not a file")
 
     @staticmethod
     def check_dirs_exist(paths):
         for path in paths:
-            if not path.exists():
+            kind = path.stat_kind()
+            if kind == "missing":
                 raise FileNotFoundError(path.path + " doesn't exist")
-            if not path.isdir():
+            if kind != "dir":
                 raise FileExistsError(path.path + " is not a directory")
 
 
 class Config:
     # pylint: disable=too-many-instance-attributes
     extra_config_stack = []
+    # Parsed configuration files, indexed by real path, so that each file is parsed only once
+    yaml_cache = {}
 
     def __init__(self, paths):
         # pylint: disable=too-many-branches
@@ -226,14 +348,7 @@ class Config:
         self.qmake_exclude_dirs = []
 
         for path in self.paths:
-            try:
-                with open(path.path, "r", encoding="utf8") as file:
-                    data = yaml.safe_load(file)
-            except OSError as exception:
-                Error.exit_on_exception("Failed opening configuration file", exception)
-            except yaml.YAMLError as exception:
-                Error.exit_on_exception("Failed parsing configuration file", exception)
-
+            data = Config.load_yaml(path)
             for key in data.keys():
                 if key == "fqbn":
                     self.fqbn = data[key]
@@ -296,6 +411,22 @@ class Config:
 
         return '\n'.join(ret)
 
+    @staticmethod
+    def load_yaml(path):
+        if path.path in Config.yaml_cache:
+            return Config.yaml_cache[path.path]
+
+        try:
+            with open(path.path, "r", encoding="utf8") as file:
+                data = yaml.load(file, Loader=_SafeLoader)
+        except OSError as exception:
+            Error.exit_on_exception("Failed opening configuration file", exception)
+        except yaml.YAMLError as exception:
+            Error.exit_on_exception("Failed parsing configuration file", exception)
+
+        Config.yaml_cache[path.path] = data
+        return data
+
     @staticmethod
     def get_extra_configs(path):
         if path in Config.extra_config_stack:
@@ -307,8 +438,7 @@ class Config:
 
         Config.extra_config_stack.append(path)
         ret = []
-        with open(path.path, "r", encoding="utf8") as file:
-            data = yaml.safe_load(file)
+        data = Config.load_yaml(path)
 
         for config in data.get("configs", []):
             config_path = Path(config, path.parent_dir())
@@ -320,87 +450,104 @@ class Config:
 
 
 class Makefile:
+    # Single line placeholders, searched as plain substrings like in Path.placeholder_regex
+    placeholder_regex = re.compile('|'.join(re.escape(placeholder) for placeholder in
+                                            sorted(Constants.makefile_placeholders(), key=len, reverse=True)
+                                            if placeholder != "LIBS_PLACEHOLDER"))
+
     def __init__(self, config, path, template_path, sketch_path):
         self.path = path
+        self.makefile_dir = path.parent_dir()
         self.config = config
-        self.sketch_path = sketch_path.to_relative(path.parent_dir())
+        self.sketch_path = sketch_path.to_relative(self.makefile_dir)
         self.template_path = template_path
+        # Single line replacements, LIBS_PLACEHOLDER is handled separately since it expands to several lines
+        self.replacements = {
+            "FQBN_PLACEHOLDER": self.config.fqbn,
+            "BINDIR_PLACEHOLDER": self.bindir(),
+            "BINFILE_PLACEHOLDER": os.path.basename(self.sketch_path.with_extension(".ino.bin").path),
+            "CFLAGS_PLACEHOLDER": ' '.join(self.config.cflags),
+            "SKETCH_NOEXT_PLACEHOLDER": self.sketch_path.with_extension("").rel_path(),
+            "DEBUG_COMMAND_PLACEHOLDER": self.config.debug_command,
+            "BAUDRATE_PLACEHOLDER": str(self.config.baudrate),
+        }
 
     def generate(self):
         self.path.safely_remove_or_exit()
 
         print("Generating " + self.path.path + "...")
-        in_lines = self.template_path.read_lines()
-        out_lines = Constants.header_strings()
-        for line in in_lines:
-            out_lines += self.replace_tokens(line, self.sketch_path)
+        out_lines = list(Constants.header_strings())
+        for placeholders, line in self.template_path.read_template():
+            out_lines += self.replace_tokens(placeholders, line)
         self.path.write_lines(out_lines)
         print("Done")
 
-    def replace_tokens(self, line, sketch_path):
-        # pylint: disable=too-many-return-statements,too-many-branches
-        if "LIBS_PLACEHOLDER" in line:
-            ret = []
-            Path.check_dirs_exist(self.config.lib_paths)
-            for lib_path in self.config.lib_paths:
-                if lib_path.isuser():
-                    lib_path_string = os.path.join("$(HOME)", lib_path.rel_path())
-                elif lib_path.isrel():
-                    lib_path_string = os.path.join("$(MAKEFILE_DIR)", lib_path.to_relative(self.path.parent_dir()).rel_path())
-                else:
-                    lib_path_string = str(lib_path)
-                ret.append("\t\t--library \"" + lib_path_string + "\" \\\n")
-            return ret
-        if "FQBN_PLACEHOLDER" in line:
-            return [line.replace("FQBN_PLACEHOLDER", self.config.fqbn)]
-        if "BINDIR_PLACEHOLDER" in line:
-            bindir = "bin"
-            bindir_suffix = self.path.basename().replace("Makefile", "", 1)
-            if bindir_suffix:
-                bindir += bindir_suffix
-            return [line.replace("BINDIR_PLACEHOLDER", bindir)]
-        if "BINFILE_PLACEHOLDER" in line:
-            return [line.replace("BINFILE_PLACEHOLDER", os.path.basename(sketch_path.with_extension(".ino.bin").path))]
-        if "CFLAGS_PLACEHOLDER" in line:
-            return [line.replace("CFLAGS_PLACEHOLDER", ' '.join(self.config.cflags))]
-        if "SKETCH_NOEXT_PLACEHOLDER" in line:
-            return [line.replace("SKETCH_NOEXT_PLACEHOLDER", sketch_path.to_relative(self.path.parent_dir()).
-                                 with_extension("").rel_path())]
-        if "DEBUG_COMMAND_PLACEHOLDER" in line:
-            return [line.replace("DEBUG_COMMAND_PLACEHOLDER", self.config.debug_command)]
-        if "BAUDRATE_PLACEHOLDER" in line:
-            return [line.replace("BAUDRATE_PLACEHOLDER", self.config.baudrate)]
-
-        return [line]
+    def replace_tokens(self, placeholders, line):
+        if not placeholders:
+            return [line]
+        if "LIBS_PLACEHOLDER" in placeholders:
+            return self.libs_lines()
+        return [Makefile.placeholder_regex.sub(lambda match: self.replacements[match.group(0)], line)]
+
+    def bindir(self):
+        bindir = "bin"
+        bindir_suffix = self.path.basename().replace("Makefile", "", 1)
+        if bindir_suffix:
+            bindir += bindir_suffix
+        return bindir
+
+    def libs_lines(self):
+        ret = []
+        Path.check_dirs_exist(self.config.lib_paths)
+        for lib_path in self.config.lib_paths:
+            if lib_path.isuser():
+                lib_path_string = os.path.join("$(HOME)", lib_path.rel_path())
+            elif lib_path.isrel():
+                lib_path_string = os.path.join("$(MAKEFILE_DIR)", lib_path.to_relative(self.makefile_dir).rel_path())
+            else:
+                lib_path_string = str(lib_path)
+            ret.append("\t\t--library \"" + lib_path_string + "\" \\\n")
+        return ret
 
 
 class Qmake:
     # pylint: disable=too-many-instance-attributes
+    quoted_string_regex = re.compile(r'"([^"]*)"')
+
     def __init__(self, config, path, template_path, sketch_path, makefile_path):
         # pylint: disable=too-many-arguments
         self.path = path
+        self.qmake_dir = self.path.parent_dir()
         self.prifile_path = self.path.with_extension(".pri")
         self.config = config
         self.template_path = template_path
         self.prifile_template_path = template_path.with_extension(".pri")
-        self.sketch_path = sketch_path.to_relative(self.path.parent_dir())
+        self.sketch_path = sketch_path.to_relative(self.qmake_dir)
         self.makefile_path = makefile_path
         self.included_dirs = [self.sketch_path.parent_dir()] + config.lib_paths + config.qmake_dirs
         self.excluded_dirs = config.qmake_exclude_dirs
+        # Tuple of excluded paths, as expected by str.startswith(), with a trailing separator so that
+        # excluding some/dir doesn't exclude some/dir2
+        self.excluded_prefixes = tuple(excluded_dir.path.rstrip(os.sep) + os.sep for excluded_dir in self.excluded_dirs)
         self.script_path = self.path.with_extension("")
+        # Single line replacements, the other placeholders depend on the scanned files
+        self.replacements = {
+            "TARGET_PLACEHOLDER": self.script_path.with_extension("").to_relative(self.qmake_dir).rel_path(),
+            "MAKEFILE_PLACEHOLDER": self.makefile_path.to_relative(self.qmake_dir).rel_path(),
+            "PRIFILE_PLACEHOLDER": self.prifile_path.to_relative(self.qmake_dir).rel_path(),
+        }
 
     @staticmethod
     def headers_dirs(headers):
         ret = []
-        # Store the previous header dir to avoid calling 'if header_dir not in ret' for each header file
-        prev_header_dir = None
+        # Compare directory strings, so that a Path is built only once per directory
+        raw_header_dirs = set()
         for header in headers:
-            if prev_header_dir and prev_header_dir == header.parent_dir():
+            raw_header_dir = os.path.dirname(header.path)
+            if raw_header_dir in raw_header_dirs:
                 continue
-            header_dir = header.parent_dir()
-            prev_header_dir = header_dir
-            if header_dir not in ret:
-                ret.append(header_dir)
+            raw_header_dirs.add(raw_header_dir)
+            ret.append(header.parent_dir())
 
         return ret
 
@@ -420,22 +567,28 @@ class Qmake:
         includepaths = Qmake.headers_dirs(headers)
         print("Done")
 
-        defines = Qmake.get_defines(self.makefile_path)
+        defines = self.get_cached_defines()
+
+        # Build the file directives once, they are then filtered by path type for the .pro and .pri files
+        directives = {
+            "OTHER_FILES_PLACEHOLDER": self.to_qmake_file_directives(other_files),
+            "SOURCES_PLACEHOLDER": self.to_qmake_file_directives(sources),
+            "HEADERS_PLACEHOLDER": self.to_qmake_file_directives(headers),
+            "INCLUDEPATH_PLACEHOLDER": self.to_qmake_file_directives(includepaths),
+        }
 
         print("Generating " + self.path.path + "...")
-        in_lines = self.template_path.read_lines()
-        out_lines = Constants.header_strings()
-        for line in in_lines:
-            out_lines += self.replace_tokens(line, other_files, headers, sources, includepaths, defines,
+        out_lines = list(Constants.header_strings())
+        for placeholders, line in self.template_path.read_template():
+            out_lines += self.replace_tokens(placeholders, line, directives, defines,
                                              include_abs=False, include_rel=True, include_user=False)
         self.path.write_lines(out_lines)
         print("Done")
 
         print("Generating " + self.prifile_path.path + "...")
-        in_lines = self.prifile_template_path.read_lines()
-        out_lines = Constants.header_strings()
-        for line in in_lines:
-            out_lines += self.replace_tokens(line, other_files, headers, sources, includepaths, defines,
+        out_lines = list(Constants.header_strings())
+        for placeholders, line in self.prifile_template_path.read_template():
+            out_lines += self.replace_tokens(placeholders, line, directives, defines,
                                              include_abs=True, include_rel=False, include_user=True)
         self.prifile_path.write_lines(out_lines)
         print("Done")
@@ -447,55 +600,43 @@ class Qmake:
         self.script_path.safely_remove_or_exit()
 
         makefile_rel_path = self.makefile_path.to_relative(self.script_path.parent_dir())
-        out_lines = ["#!/bin/sh\n"] + Constants.header_strings() + ["make -f " + makefile_rel_path.rel_path() + " run\n"]
+        out_lines = ["#!/bin/sh\n", *Constants.header_strings(), "make -f " + makefile_rel_path.rel_path() + " run\n"]
         self.script_path.write_lines(out_lines)
         os.chmod(self.script_path.path, 0o0755)
 
-    def replace_tokens(self, line, other_files, headers, sources, includepaths, defines, include_abs, include_rel, include_user):
-        # pylint: disable=too-many-arguments,too-many-locals
-        qmake_dir = self.path.parent_dir()
-        if "TARGET_PLACEHOLDER" in line:
-            return [line.replace("TARGET_PLACEHOLDER", self.script_path.with_extension("").to_relative(qmake_dir).rel_path())]
-        if "MAKEFILE_PLACEHOLDER" in line:
-            return [line.replace("MAKEFILE_PLACEHOLDER", self.makefile_path.to_relative(qmake_dir).rel_path())]
-        if "PRIFILE_PLACEHOLDER" in line:
-            return [line.replace("PRIFILE_PLACEHOLDER", self.prifile_path.to_relative(qmake_dir).rel_path())]
-        if "DEFINES_PLACEHOLDER" in line:
+    def replace_tokens(self, placeholders, line, directives, defines, include_abs, include_rel, include_user):
+        # pylint: disable=too-many-arguments
+        if not placeholders:
+            return [line]
+
+        # Only one placeholder is handled per line
+        placeholder = next((placeholder for placeholder in Constants.qmake_placeholders() if placeholder in placeholders), None)
+
+        if placeholder in self.replacements:
+            return [line.replace(placeholder, self.replacements[placeholder])]
+
+        if placeholder == "DEFINES_PLACEHOLDER":
             ret = []
             for define in defines:
                 ret.append("\t" + Qmake.to_qmake_define(define) + " \\\n")
             return ret
 
-        paths = None
-
-        if "OTHER_FILES_PLACEHOLDER" in line:
-            paths = other_files
-        elif "SOURCES_PLACEHOLDER" in line:
-            paths = sources
-        elif "HEADERS_PLACEHOLDER" in line:
-            paths = headers
-        elif "INCLUDEPATH_PLACEHOLDER" in line:
-            paths = includepaths
-
-        if paths is not None:
+        if placeholder in directives:
             ret = []
-            for path in paths:
+            for path, directive in directives[placeholder]:
                 # Don't consider user paths as relative, or we'll have them in the pro and pri files
                 isrel = path.isrel() and not path.isuser()
                 # pylint: disable=too-many-boolean-expressions
                 if isrel and include_rel or path.isuser() and include_user or path.isabs() and include_abs:
-                    ret.append(Qmake.to_qmake_file_directive(path, self.path))
+                    ret.append(directive)
             return ret
 
         # Nothing to replace
-        return line
+        return [line]
 
     @staticmethod
-    def is_rawpath_excluded(raw_real_path, excluded_dirs):
-        for excluded_dir in excluded_dirs:
-            if raw_real_path.startswith(str(excluded_dir)):
-                return True
-        return False
+    def is_rawpath_excluded(raw_real_path, excluded_prefixes):
+        return (raw_real_path + os.sep).startswith(excluded_prefixes)
 
     def get_other_files(self):
         return [self.makefile_path] + self.config.paths
@@ -503,46 +644,74 @@ class Qmake:
     @staticmethod
     def raw_path_in_paths(raw_path, paths):
         for path in paths:
-            if str(path) == os.path.realpath(raw_path):
+            if str(path) == Path.realpath(raw_path):
                 return True
         return False
 
+    @staticmethod
+    def walk_files(raw_dir, excluded_prefixes, extensions, walked_real_dirs=frozenset()):
+        # Yield the files below raw_dir matching extensions, without descending into excluded directories.
+        # As with a recursive glob, hidden entries are skipped and symlinks are followed.
+        # walked_real_dirs holds the real paths of the directories being walked, so that symlink loops are not followed.
+        walked_real_dirs = walked_real_dirs | {Path.realpath(raw_dir)}
+        try:
+            with os.scandir(raw_dir) as iterator:
+                entries = list(iterator)
+        except OSError:
+            return
+        for entry in entries:
+            if entry.name.startswith("."):
+                continue
+            try:
+                is_dir = entry.is_dir()
+                is_file = not is_dir and entry.is_file()
+            except OSError:
+                # Broken entries, such as symlink loops, are skipped like glob does
+                continue
+            if is_dir:
+                real_dir = Path.realpath(entry.path)
+                if real_dir not in walked_real_dirs and not Qmake.is_rawpath_excluded(real_dir, excluded_prefixes):
+                    yield from Qmake.walk_files(entry.path, excluded_prefixes, extensions, walked_real_dirs)
+            elif is_file:
+                name, _, extension = entry.name.rpartition(".")
+                if name and extension in extensions:
+                    yield entry.path
+
     def get_files(self, extensions):
         ret = []
-        raw_paths = []
+        raw_paths = set()
+        # Extensions without their leading dot, as returned by str.rpartition() in walk_files()
+        extensions = {extension.lstrip(".") for extension in extensions}
         for included_dir in self.included_dirs:
-            for raw_path in glob.iglob(os.path.join(included_dir.path, "**"), recursive=True):
-                raw_real_path = os.path.realpath(raw_path)
-                if Qmake.is_rawpath_excluded(raw_real_path, self.excluded_dirs):
-                    continue
-                if not os.path.isfile(raw_real_path):
-                    continue
-                if os.path.splitext(raw_real_path)[-1] not in extensions:
+            for raw_path in Qmake.walk_files(included_dir.path, self.excluded_prefixes, extensions):
+                raw_real_path = Path.realpath(raw_path)
+                if Qmake.is_rawpath_excluded(raw_real_path, self.excluded_prefixes):
                     continue
                 if raw_real_path in raw_paths:
                     continue
-                ret.append(Qmake.path_from_ancestor(included_dir, self.path, raw_real_path))
-                raw_paths.append(os.path.realpath(raw_real_path))
+                ret.append(Qmake.path_from_ancestor(included_dir, self.qmake_dir, raw_real_path))
+                raw_paths.add(raw_real_path)
         return ret
 
     @staticmethod
-    def path_from_ancestor(ancestor, qmake_path, raw_path):
+    def path_from_ancestor(ancestor, qmake_dir, raw_real_path):
         if ancestor.isuser():
-            new_path = Path(os.path.join("~/", os.path.relpath(raw_path, os.path.expanduser("~/"))))
-        elif ancestor.isabs():
-            new_path = Path(raw_path)
-        else:
-            new_path = Path(raw_path).to_relative(qmake_path.parent_dir())
-        return new_path
+            return Path.from_real_path(raw_real_path, Path.Type.User, Paths.home_dir())
+        if ancestor.isabs():
+            return Path.from_real_path(raw_real_path, Path.Type.Absolute)
+        return Path.from_real_path(raw_real_path, Path.Type.Relative, qmake_dir)
+
+    def to_qmake_file_directives(self, file_paths):
+        return [(file_path, Qmake.to_qmake_file_directive(file_path, self.qmake_dir)) for file_path in file_paths]
 
     @staticmethod
-    def to_qmake_file_directive(file_path, qmake_path):
+    def to_qmake_file_directive(file_path, qmake_dir):
         if file_path.isuser():
             path_string = "$$HOME/" + file_path.rel_path()
         elif file_path.isabs():
             path_string = file_path.path
         else:
-            path_string = file_path.to_relative(qmake_path.parent_dir()).rel_path()
+            path_string = file_path.to_relative(qmake_dir).rel_path()
         return "\t" + path_string + " \\\n"
 
     @staticmethod
@@ -553,18 +722,67 @@ class Qmake:
         return define
 
     @staticmethod
-    def make_rule(makefile_path, rule):
-        build_cmd = ["make", "-C", os.path.dirname(makefile_path.path), "-f", makefile_path.path, rule]
+    def make_rules(makefile_path, *rules):
+        # Rules are run in the given order, -j1 prevents an inherited MAKEFLAGS from running them in parallel
+        build_cmd = ["make", "-j1", "-C", os.path.dirname(makefile_path.path), "-f", makefile_path.path, *rules]
         return subprocess.check_output(build_cmd, stderr=subprocess.PIPE).decode("utf8")
 
+    def defines_cache_path(self):
+        return self.path.with_path(self.path.path + ".defines")
+
+    def defines_cache_key(self):
+        # The Makefile holds everything we pass to arduino-cli (fqbn, cflags, libs, sketch path). The sketch contents
+        # don't change the compiler -D flags, so they are not part of the key. Installed board packages and toolchains
+        # do change them but are not tracked, the cache file has to be removed after updating them.
+        key = hashlib.blake2b()
+        with open(self.makefile_path.path, "rb") as file:
+            key.update(file.read())
+        return key.hexdigest()
+
+    @staticmethod
+    def read_cached_defines(cache_path, cache_key):
+        # The cache file holds our header strings followed by some json data
+        if not cache_path.generated_by_us():
+            return None
+        try:
+            lines = cache_path.read_lines()
+            data = json.loads(''.join(line for line in lines if not line.startswith("#")))
+        except (OSError, ValueError):
+            return None
+        if not isinstance(data, dict) or data.get("key") != cache_key:
+            return None
+        defines = data.get("defines")
+        if not isinstance(defines, list) or not all(isinstance(define, str) for define in defines):
+            return None
+        return defines
+
+    def get_cached_defines(self):
+        # Building the sketch is by far the longest step, so reuse the previous defines when the inputs didn't change
+        cache_path = self.defines_cache_path()
+        cache_key = self.defines_cache_key()
+        defines = Qmake.read_cached_defines(cache_path, cache_key)
+        if defines is not None:
+            print("Using preprocessor defines from " + cache_path.path)
+            return defines
+
+        cache_path.safely_remove_or_exit()
+        defines = Qmake.get_defines(self.makefile_path)
+        if defines is None:
+            return []
+
+        try:
+            cache_path.write_lines(list(Constants.header_strings()) + [json.dumps({"key": cache_key, "defines": defines}, indent=4), "\n"])
+        except OSError as exception:
+            print("Warning: failed writing " + cache_path.path + ": " + str(exception))
+        return defines
+
     @staticmethod
     def get_defines(makefile_path):
-        defines = []
         print("Building sketch to check proprocessor defines...")
         try:
-            Qmake.make_rule(makefile_path, "clean")
-            output = Qmake.make_rule(makefile_path, "build")
-            Qmake.make_rule(makefile_path, "clean")
+            # make builds each target at most once per invocation, so the final clean needs its own one
+            output = Qmake.make_rules(makefile_path, "clean", "build")
+            Qmake.make_rules(makefile_path, "clean")
             print("Done")
         except subprocess.CalledProcessError as e:
             print("Got an exception while building the project, DEFINES variable won't be set in your qmake project")
@@ -574,7 +792,7 @@ class Qmake:
             print(e.stderr.decode("utf8"))
             print("***")
             print()
-            return []
+            return None
 
         # Convert the raw output to an array of command lines issued during compilation
         cmd = ""
@@ -588,6 +806,8 @@ class Qmake:
                 cmds.append(cmd)
             cmd = ""
 
+        # Use a dict as an insertion ordered set of defines
+        defines = {}
         for cmd in cmds:
             # Skip the line which contains arduino-cli, we'll check only the compiler output
             if cmd.split()[0].endswith("arduino-cli"):
@@ -595,21 +815,15 @@ class Qmake:
             # This is a pretty dirty trick to handle the \" in the compiler command line
             # There is probably a much better way to handle them, but this seems to work decently...
             cmd = cmd.replace("\\\"", "BACKSLASH_QUOTE")
-            quoted_strings = re.findall(r'"([^"]*)"', cmd)
-            for quoted_string in quoted_strings:
+            for quoted_string in Qmake.quoted_string_regex.findall(cmd):
                 if quoted_string.startswith("-D"):
-                    define = quoted_string.replace("BACKSLASH_QUOTE", "\\\"")
-                    if define not in defines:
-                        defines.append(define)
+                    defines.setdefault(quoted_string.replace("BACKSLASH_QUOTE", "\\\""))
 
-            tokens = cmd.split()
-            for token in tokens:
-                if (token.startswith("-D") or token.startswith("\"-D") or token.startswith("\'-D")) \
-                        and "BACKSLASH_QUOTE" not in token:
-                    if token not in defines:
-                        defines.append(token)
+            for token in cmd.split():
+                if token.startswith(("-D", "\"-D", "\'-D")) and "BACKSLASH_QUOTE" not in token:
+                    defines.setdefault(token)
 
-        return defines
+        return list(defines)
 
 
 def main():
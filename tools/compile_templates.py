@@ -0,0 +1,40 @@
+#!/usr/bin/python3
+
+# pylint: disable=invalid-name,missing-module-docstring,missing-function-docstring
+
+import argparse
+import importlib.util
+import os
+
+
+def load_genmakefile():
+    script_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "arduino-genmakefile.py")
+    spec = importlib.util.spec_from_file_location("arduino_genmakefile", script_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def main():
+    description = """
+Tokenize templates in advance, so that arduino-genmakefile.py doesn't need to scan them for placeholders.
+For each template, a .tmpl.json file is written next to it. It is used as long as it is newer than the template.
+"""
+    genmakefile = load_genmakefile()
+    templates_dir = genmakefile.Paths.templates_dir().path
+    default_templates = sorted(os.path.join(templates_dir, name) for name in os.listdir(templates_dir)
+                               if not name.endswith(".tmpl.json"))
+
+    parser = argparse.ArgumentParser(description=description, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("templates", help="Template paths, default to all files of the templates directory", nargs="*",
+                        default=default_templates)
+    args = parser.parse_args()
+
+    for template in args.templates:
+        template_path = genmakefile.Path(template, os.getcwd())
+        template_path.write_compiled_template()
+        print("Generated " + template_path.compiled_template_path().path)
+
+
+if __name__ == '__main__':
+    main()